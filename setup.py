@@ -34,7 +34,7 @@ setuptools.setup(
             "align-fits-simple=spalipy.spalipy:main_simple",
         ]
     },
-    install_requires=["astropy>=3.2.2", "numpy>=1.10", "scipy>=1.1.0", "sep>=1.1.1"][::-1],
+    install_requires=["astropy>=3.2.2", "numpy>=1.10", "scipy>=1.6.0", "sep>=1.1.1"][::-1],
     classifiers=[
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
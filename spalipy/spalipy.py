@@ -17,6 +17,7 @@ import argparse
 import itertools
 import logging
 import os
+import warnings
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from typing import Optional, Union
@@ -28,9 +29,9 @@ from astropy.io import fits
 from astropy.table import Table, vstack
 from scipy import linalg, interpolate
 from scipy.ndimage import interpolation, map_coordinates
-from scipy.spatial import cKDTree, distance
+from scipy.spatial import cKDTree
 
-from spalipy.utils import _c_array_prep, _memmap_tryfree, _memmap_create_temp
+from spalipy.utils import _c_array_prep, _memmap_tryfree, _memmap_create_empty
 
 # expose dfitpack errors so we can catch them later
 try:
@@ -53,6 +54,8 @@ class AffineTransform:
 
     def __init__(self, v):
         self.v = np.asarray(v)
+        self._inverse = None
+        self._matrix_form = None
 
     @property
     def scale(self):
@@ -65,24 +68,35 @@ class AffineTransform:
         return np.deg2rad(np.arctan2(self.v[1], self.v[0]))
 
     def inverse(self):
-        """Returns the inverse transform"""
-
-        # To represent affine transformations with matrices,
-        # we can use homogeneous coordinates.
-        homo = np.array(
-            [[self.v[0], -self.v[1], self.v[2]], [self.v[1], self.v[0], self.v[3]], [0.0, 0.0, 1.0]]
-        )
-        inv = linalg.inv(homo)
+        """Returns the inverse transform (cached after first call)"""
+
+        if self._inverse is None:
+            # To represent affine transformations with matrices,
+            # we can use homogeneous coordinates.
+            homo = np.array(
+                [
+                    [self.v[0], -self.v[1], self.v[2]],
+                    [self.v[1], self.v[0], self.v[3]],
+                    [0.0, 0.0, 1.0],
+                ]
+            )
+            inv = linalg.inv(homo)
+            self._inverse = AffineTransform((inv[0, 0], inv[1, 0], inv[0, 2], inv[1, 2]))
 
-        return AffineTransform((inv[0, 0], inv[1, 0], inv[0, 2], inv[1, 2]))
+        return self._inverse
 
     def matrix_form(self):
         """
         Special output for scipy.ndimage.interpolation.affine_transform
-        Returns (matrix, offset)
+        Returns (matrix, offset) (cached after first call)
         """
 
-        return np.array([[self.v[0], -self.v[1]], [self.v[1], self.v[0]]]), self.v[2:4]
+        if self._matrix_form is None:
+            self._matrix_form = (
+                np.array([[self.v[0], -self.v[1]], [self.v[1], self.v[0]]]),
+                self.v[2:4],
+            )
+        return self._matrix_form
 
     def apply_transform(self, xy):
         """Applies the transform to an array of x, y points"""
@@ -180,7 +194,8 @@ class Spalipy:
         The spline order to use for interpolation - this is passed
         directly to `scipy.ndimage.affine_transform` and
         `scipy.ndimage.interpolation.map_coordinates` as the `order`
-        argument. Must be in the range 0-5.
+        argument. Must be in the range 0-5. For orders up to 3 the
+        interpolation is performed (and aligned data returned) in float32.
     sep_thresh : float, optional
         The threshold value to pass to `sep.extract()`.
     min_fwhm : float, optional
@@ -215,6 +230,8 @@ class Spalipy:
         Source and Template data is converted to float64 internally,
         if true, a copy of the input data is made to avoid modifying
         the original, otherwise the input data is modified in-place if possible.
+        Data already in float64 format is always referenced directly without
+        copying, regardless of this value.
     use_memmap : boolean, optional (default=False)
         If source data are np.memmap ndarrays, attempt to free memory
         after reading. NB: this will clear any array changes that have not
@@ -239,6 +256,11 @@ class Spalipy:
     flag_col = "flag"
     columns = [x_col, y_col, flux_col, fwhm_col, flag_col]
 
+    # Spacing in pixels of the coarse grid on which the affine + spline
+    # coordinate transform is evaluated before being bilinearly upsampled
+    # to the full image grid in `_transform_data()`
+    coarse_grid_step = 10
+
     def __init__(
         self,
         source_data: Union[np.ndarray, list],
@@ -309,6 +331,10 @@ class Spalipy:
             source_data = [source_data]
             self._source_inputs_as_list = False
         else:
+            # Shallow-copy the list container (the data arrays themselves are
+            # referenced, not copied) so any in-place dtype conversion below
+            # does not mutate the caller's list
+            source_data = list(source_data)
             self._source_inputs_as_list = True
 
         self._n_source_entry = len(source_data)
@@ -509,7 +535,10 @@ class Spalipy:
         # .. because template quads are flattened instead of split by sub-tile
         # since we cannot be sure that image overlap means sub-tiles in the
         # source correspond to those in the template
-        self.template_quadlist = [q for quadlist in template_quadlist for q in quadlist]
+        self.template_quadlist = (
+            np.concatenate([quad_coo for quad_coo, _ in template_quadlist]),
+            np.concatenate([quad_hashes for _, quad_hashes in template_quadlist]),
+        )
 
     def fit_affine_transform(self):
         """
@@ -546,7 +575,8 @@ class Spalipy:
         Returns the source and template matched detections, and the affine transform.
         """
         # Template quads are always flattened
-        template_hash = np.array([q[1] for q in self.template_quadlist])
+        template_quad_coo, template_hash = self.template_quadlist
+        template_hash_tree = cKDTree(template_hash)
 
         n_match_full = 0
         source_det_matched_full = []
@@ -554,7 +584,7 @@ class Spalipy:
         # Iterate over each sub-tile in the source_data and perform cross-matching
         # using a per-sub-tile transform
         entry_shape = self._source_data[entry].shape
-        for i, (source_quadlist, source_det) in enumerate(
+        for i, ((source_quad_coo, source_hash), source_det) in enumerate(
             zip(
                 self._source_quadlist[entry],
                 self._sub_tile_det(self._source_det[entry], entry_shape),
@@ -562,10 +592,9 @@ class Spalipy:
             1,
         ):
             logging.debug(f"Processing sub-tile region {i}/{self.sub_tile ** 2}")
-            source_hash = np.array([q[1] for q in source_quadlist])
-            dists = distance.cdist(template_hash, source_hash)
-            min_dist_idx = np.argmin(dists, axis=0)
-            min_dist = np.min(dists, axis=0)
+            # Query only the nearest template quad per source quad, rather than
+            # materialising the full template x source distance matrix
+            min_dist, min_dist_idx = template_hash_tree.query(source_hash, k=1, workers=-1)
             best = np.argsort(min_dist)
             if not np.any(min_dist < self.max_quad_hash_dist):
                 logging.warning(
@@ -576,9 +605,13 @@ class Spalipy:
 
             patience = 0
             best_n_match = 0
-            source_det_matched = []
-            template_det_matched = []
+            best_matched_mask = None
+            best_template_idxs = None
             n_quad_cand = min(self.max_quad_cand, len(best))
+            # Work on the cached coordinate arrays within the candidate loop -
+            # the matched detection tables are only materialised once the best
+            # candidate has been settled on
+            source_coo = self._get_det_coords(source_det)
 
             for j in range(n_quad_cand):
                 logging.debug(
@@ -589,34 +622,31 @@ class Spalipy:
                 dist = min_dist[bi]
                 if dist < self.max_quad_hash_dist:
                     # Get a quick (exact) transformation guess using first two detections
-                    template_quad = self.template_quadlist[min_dist_idx[bi]]
-                    source_quad = source_quadlist[bi]
-
                     initial_affine_transform = calc_affine_transform(
-                        source_quad[0][:2], template_quad[0][:2]
+                        source_quad_coo[bi, :2], template_quad_coo[min_dist_idx[bi], :2]
                     )
-                    n_match, _source_det_matched, _template_det_matched = self._match_dets(
-                        source_det, initial_affine_transform
+                    matched_mask, template_idxs = self._match_coo(
+                        initial_affine_transform.apply_transform(source_coo)
                     )
+                    n_match = np.sum(matched_mask)
 
                     if n_match:
                         # Refine the transformation using the coordinates of the matched detections
-                        source_match_coo = self._get_det_coords(_source_det_matched)
-                        template_match_coo = self._get_det_coords(_template_det_matched)
                         _affine_transform = calc_affine_transform(
-                            source_match_coo, template_match_coo
+                            source_coo[matched_mask], self.template_coo[template_idxs]
                         )
-                        n_match, _source_det_matched, _template_det_matched = self._match_dets(
-                            source_det, _affine_transform
+                        matched_mask, template_idxs = self._match_coo(
+                            _affine_transform.apply_transform(source_coo)
                         )
+                        n_match = np.sum(matched_mask)
 
                         if n_match > best_n_match:
                             logging.info(
                                 f"Found new best number of matched detections ({n_match})"
                                 " - updating transform"
                             )
-                            source_det_matched = _source_det_matched
-                            template_det_matched = _template_det_matched
+                            best_matched_mask = matched_mask
+                            best_template_idxs = template_idxs
                             best_n_match = n_match
                             patience = 0
                         else:
@@ -628,8 +658,9 @@ class Spalipy:
                             )
                             break
             n_match_full += best_n_match
-            source_det_matched_full.append(source_det_matched)
-            template_det_matched_full.append(template_det_matched)
+            if best_n_match:
+                source_det_matched_full.append(source_det[best_matched_mask])
+                template_det_matched_full.append(self.template_det[best_template_idxs])
 
         if n_match_full < self.min_n_match:
             logging.error(
@@ -708,26 +739,62 @@ class Spalipy:
         template_coo = self._get_det_coords(self._template_det_matched[entry])
 
         # Create splines describing the residual offsets in x and y left over
-        # after the affine transformation
+        # after the affine transformation. A least-squares spline with a fixed
+        # grid of interior knots is used since FITPACK's adaptive knot
+        # placement (SmoothBivariateSpline) is slow and can be unstable on
+        # scattered data
         kx = ky = self.spline_order
-        try:
-            sbs_x = interpolate.SmoothBivariateSpline(
-                template_coo[:, 0],
-                template_coo[:, 1],
-                (template_coo[:, 0] - source_coo[:, 0]),
-                kx=kx,
-                ky=ky,
-            )
-            sbs_y = interpolate.SmoothBivariateSpline(
-                template_coo[:, 0],
-                template_coo[:, 1],
-                (template_coo[:, 1] - source_coo[:, 1]),
-                kx=kx,
-                ky=ky,
-            )
-        except dfitpackError:
+        x = template_coo[:, 0]
+        y = template_coo[:, 1]
+        residuals_x = template_coo[:, 0] - source_coo[:, 0]
+        residuals_y = template_coo[:, 1] - source_coo[:, 1]
+
+        # A well-conditioned least-squares surface cannot wildly exceed the
+        # residuals it is fitted to, so bound the fitted offset fields by the
+        # data residuals - fits violating this (FITPACK rank deficiency) are
+        # rejected and retried with fewer knots
+        residual_bound = 100 * max(np.max(np.abs(residuals_x)), np.max(np.abs(residuals_y)), 1.0)
+        eval_x = np.linspace(x.min(), x.max(), 25)
+        eval_y = np.linspace(y.min(), y.max(), 25)
+
+        # Start with as many interior knots per axis as the matched-detection
+        # density supports (several points per spline coefficient) and back
+        # off towards zero interior knots (a global polynomial fit) if the
+        # system is rank deficient
+        max_n_knots = min(4, max(0, int(np.sqrt(len(x) / 3)) - kx - 1))
+        sbs_x = sbs_y = None
+        for n_knots in range(max_n_knots, -1, -1):
+            tx = np.linspace(x.min(), x.max(), n_knots + 2)[1:-1]
+            ty = np.linspace(y.min(), y.max(), n_knots + 2)[1:-1]
+            try:
+                with warnings.catch_warnings():
+                    # Rank-deficiency warnings are dealt with by the
+                    # bound check below
+                    warnings.simplefilter("ignore")
+                    _sbs_x = interpolate.LSQBivariateSpline(
+                        x, y, residuals_x, tx, ty, kx=kx, ky=ky
+                    )
+                    _sbs_y = interpolate.LSQBivariateSpline(
+                        x, y, residuals_y, tx, ty, kx=kx, ky=ky
+                    )
+            except (dfitpackError, ValueError):
+                continue
+            if (
+                np.max(np.abs(_sbs_x(eval_x, eval_y))) <= residual_bound
+                and np.max(np.abs(_sbs_y(eval_x, eval_y))) <= residual_bound
+            ):
+                sbs_x = _sbs_x
+                sbs_y = _sbs_y
+                if n_knots < max_n_knots:
+                    logging.info(
+                        f"Reduced spline interior knots to {n_knots} per axis "
+                        "to obtain a conditioned fit"
+                    )
+                break
+        if sbs_x is None:
             logging.error(
-                "scipy.interpolate.SmoothBivariateSpline raised dfitpackError (not enough sources?)"
+                "Could not fit conditioned spline surfaces to the matched "
+                "detection residuals (not enough sources?)"
             )
             logging.error(f"Alignment failed for entry {entry}")
             self._alignment_failed[entry] = True
@@ -760,17 +827,37 @@ class Spalipy:
 
     def full_transform(self, coo, entry, inverse=True):
         """Return transformed coordinates including both affine and spline transforms"""
-        # Need to correct the spline coordinates used for any anchoring (padding) done to the
-        # coordinate system when preserving footprints.
-        spline_coo_offset = np.array([self._anchor_height, self._anchor_width]).reshape(2, 1, 1)
+        affine_transform = self._affine_transform[entry]
+        if inverse:
+            affine_transform = affine_transform.inverse()
+        ft = affine_transform.apply_transform(coo)
+        if self._spline_transform is None or self._spline_transform[entry] is None:
+            return ft
+
+        # Evaluate the residual spline offsets directly and accumulate them
+        # onto the (freshly allocated) affine result in place, avoiding the
+        # intermediate coordinate repacking of the spline_transform callable.
+        # The spline coordinates need correcting for any anchoring (padding)
+        # done to the coordinate system when preserving footprints.
+        coo = np.asarray(coo)
+        if coo.ndim == 2:
+            x = coo[:, 0] - self._anchor_height
+            y = coo[:, 1] - self._anchor_width
+            ft_x = ft[:, 0]
+            ft_y = ft[:, 1]
+        else:
+            x = coo[0] - self._anchor_height
+            y = coo[1] - self._anchor_width
+            ft_x = ft[0]
+            ft_y = ft[1]
+        spline_x_offsets = self._sbs_x[entry].ev(x, y)
+        spline_y_offsets = self._sbs_y[entry].ev(x, y)
         if inverse:
-            ft = self._affine_transform[entry].inverse().apply_transform(coo)
-            if self._spline_transform is not None and self._spline_transform[entry] is not None:
-                ft = ft + self._spline_transform[entry](coo - spline_coo_offset, relative=True)
+            np.subtract(ft_x, spline_x_offsets, out=ft_x)
+            np.subtract(ft_y, spline_y_offsets, out=ft_y)
         else:
-            ft = self._affine_transform[entry].apply_transform(coo)
-            if self._spline_transform is not None and self._spline_transform[entry] is not None:
-                ft = ft - self._spline_transform[entry](coo - spline_coo_offset, relative=True)
+            np.add(ft_x, spline_x_offsets, out=ft_x)
+            np.add(ft_y, spline_y_offsets, out=ft_y)
         return ft
 
     def transform_data(self):
@@ -899,63 +986,118 @@ class Spalipy:
         source entry).
         """
         aligned_mask = None
+        # float32 carries ample precision for a resampling at these spline
+        # orders and halves the memory bandwidth of the interpolation, which
+        # is the dominant cost for large images
+        interp_dtype = np.float32 if self.interp_order <= 3 else np.float64
+        source_data = self._source_data[entry]
+        if source_data.dtype != interp_dtype:
+            source_data = source_data.astype(interp_dtype)
         if self._spline_transform is not None and self._spline_transform[entry] is not None:
             logging.info("Applying affine + spline transformation to source_data")
-            xx, yy = np.meshgrid(
-                np.arange(self._output_shape[entry][0]), np.arange(self._output_shape[entry][1])
+            # The affine + spline transform is smooth, so evaluate it on a
+            # coarse grid of pixel coordinates and bilinearly upsample the
+            # resulting coordinate map to the full output grid. This is exact
+            # for the affine component and introduces only a tiny error in the
+            # spline residual component, at a fraction of the cost of
+            # evaluating the transform for every output pixel.
+            out_height, out_width = self._output_shape[entry]
+            step = self.coarse_grid_step
+            grid_x = np.arange(0, out_height + step, step, dtype=np.float64)
+            grid_y = np.arange(0, out_width + step, step, dtype=np.float64)
+            # The coarse grid is a tensor product of 1D coordinate ranges, so
+            # the affine part can be formed by broadcasting and the residual
+            # splines evaluated in grid mode - a single FITPACK call per
+            # spline instead of a pointwise evaluation per grid coordinate
+            v = self._affine_transform[entry].inverse().v
+            coarse_coords = np.stack(
+                (
+                    v[0] * grid_y[:, None] - v[1] * grid_x[None, :] + v[2],
+                    v[1] * grid_y[:, None] + v[0] * grid_x[None, :] + v[3],
+                )
+            )
+            coarse_coords[0] -= self._sbs_x[entry](
+                grid_y - self._anchor_height, grid_x - self._anchor_width
             )
-            yyxx = np.array([yy, xx])  # curtail memory peak with yyxx
-            del xx, yy
-            full_transform_coords_shift = self.full_transform(yyxx, entry)
-            del yyxx
-            aligned_data = map_coordinates(
-                self._source_data[entry].T,
+            coarse_coords[1] -= self._sbs_y[entry](
+                grid_y - self._anchor_height, grid_x - self._anchor_width
+            )
+            # Upsample directly into row-major (numpy-order) coordinate maps -
+            # swapping the coordinate channels here saves transposing the
+            # source data in and the aligned data back out again
+            fractional_i, fractional_j = np.meshgrid(
+                np.arange(out_height) / step, np.arange(out_width) / step, indexing="ij"
+            )
+            full_transform_coords_shift = np.empty((2, out_height, out_width), dtype=interp_dtype)
+            for k in range(2):
+                map_coordinates(
+                    coarse_coords[1 - k],
+                    [fractional_j, fractional_i],
+                    order=1,
+                    output=full_transform_coords_shift[k],
+                )
+            del coarse_coords, fractional_i, fractional_j
+            aligned_data = self._aligned_output_array(self._output_shape[entry], interp_dtype)
+            map_coordinates(
+                source_data,
                 full_transform_coords_shift,
                 order=self.interp_order,
                 cval=self.cval,
-            ).T
+                output=aligned_data,
+            )
             if self.use_memmap:
                 _memmap_tryfree(self._source_data[entry])
-                aligned_data = _memmap_create_temp(aligned_data, temp_dir=self.temp_dir)
             if self._source_mask[entry] is not None:
-                aligned_mask = map_coordinates(
-                    self._source_mask[entry].T,
+                aligned_mask = self._aligned_output_array(
+                    self._output_shape[entry], self._source_mask[entry].dtype
+                )
+                map_coordinates(
+                    self._source_mask[entry],
                     full_transform_coords_shift,
                     order=0,
                     cval=self.cval_mask,
-                ).T
+                    output=aligned_mask,
+                )
                 if self.use_memmap:
                     _memmap_tryfree(self._source_mask[entry])
-                    aligned_mask = _memmap_create_temp(aligned_mask, temp_dir=self.temp_dir)
         else:
             logging.info("Applying affine transformation to source_data")
             matrix, offset = self._affine_transform[entry].inverse().matrix_form()
-            aligned_data = interpolation.affine_transform(
-                self._source_data[entry],
+            aligned_data = self._aligned_output_array(self._output_shape[entry], interp_dtype)
+            interpolation.affine_transform(
+                source_data,
                 matrix.T,
                 offset=offset[::-1],
                 order=self.interp_order,
-                output_shape=self._output_shape[entry],
                 cval=self.cval,
+                output=aligned_data,
             )
             if self.use_memmap:
                 _memmap_tryfree(self._source_data[entry])
-                aligned_data = _memmap_create_temp(aligned_data, temp_dir=self.temp_dir)
             if self._source_mask[entry] is not None:
-                aligned_mask = interpolation.affine_transform(
+                aligned_mask = self._aligned_output_array(
+                    self._output_shape[entry], self._source_mask[entry].dtype
+                )
+                interpolation.affine_transform(
                     self._source_mask[entry],
                     matrix.T,
                     offset=offset[::-1],
                     order=0,
-                    output_shape=self._output_shape[entry],
                     cval=self.cval_mask,
+                    output=aligned_mask,
                 )
                 if self.use_memmap:
                     _memmap_tryfree(self._source_mask[entry])
-                    aligned_mask = _memmap_create_temp(aligned_mask, temp_dir=self.temp_dir)
 
         return aligned_data, aligned_mask
 
+    def _aligned_output_array(self, shape, dtype):
+        """Return an array for interpolation output to be written into
+        directly - a temporary-file memmap when `use_memmap` is set"""
+        if self.use_memmap:
+            return _memmap_create_empty(shape, dtype, temp_dir=self.temp_dir)
+        return np.empty(shape, dtype=dtype)
+
     def log_transform_stats(self):
         for i in range(len(self._source_data)):
             logging.info(f"\nSource entry {i}:")
@@ -966,9 +1108,14 @@ class Spalipy:
             logging.info(f"y = {dy_mean:.3f}, {dy_med:.3f} ({dy_std:.3f})")
 
     def _get_det_coords(self, det):
-        """Return 2D array of x, y pixel coordinates from a detection table"""
-        cat_arr = det[self.x_col, self.y_col].as_array()
-        return cat_arr.view((cat_arr.dtype[0], 2))
+        """Return a contiguous (N, 2) float64 array of x, y pixel coordinates
+        from a detection table"""
+        return np.column_stack(
+            (
+                np.asarray(det[self.x_col].data, dtype=np.float64),
+                np.asarray(det[self.y_col].data, dtype=np.float64),
+            )
+        )
 
     def _sub_tile_coo(self, coo, shape, edge_buffer=0):
         """Return a generator of coordinates in each sub-tile"""
@@ -1042,12 +1189,17 @@ class Spalipy:
         det = det[(det[self.flag_col] & self.bad_flag_bits) == 0]
         det.sort(self.flux_col, reverse=True)
 
+        # When a fixed number of detections is requested, restrict the
+        # close-pair removal to a generous pool of the brightest detections so
+        # the tree build and pair query do not scale with the full catalogue
+        if isinstance(self.n_det, int) and self.n_det > 0:
+            det = det[: max(4 * self.n_det, 1000)]
+
         if self.min_sep > 0:
             tree = cKDTree(self._get_det_coords(det))
-            close_pairs = tree.query_pairs(self.min_sep)
-            to_remove = [det for pair in close_pairs for det in pair]
-            if to_remove:
-                det.remove_rows(np.unique(to_remove))
+            close_pairs = tree.query_pairs(self.min_sep, output_type="ndarray")
+            if len(close_pairs):
+                det.remove_rows(np.unique(close_pairs))
 
         if isinstance(self.n_det, float):
             n_det = int(self.n_det * len(det))
@@ -1070,8 +1222,9 @@ class Spalipy:
         """
         Create hashes for "quads" of detection coordinates
 
-        The quads are returned in a list of lists, where each parent list
-        represents the quads made in a separate sub_tile of the image.
+        The quads are returned as a list of (coordinates, hashes) array pairs,
+        of shapes (nquads, 4, 2) and (nquads, 4), one pair per sub_tile of the
+        image.
 
         shape is used when iterating over subtiles.
         """
@@ -1088,14 +1241,19 @@ class Spalipy:
                 n_quad_det = len(_coo)
             else:
                 n_quad_det = self.n_quad_det
-            subtile_quadlist = []
-            quad_idxs = itertools.combinations(range(n_quad_det), 4)
-            for quad_idx in quad_idxs:
-                four_detections_coo = _coo[quad_idx, :]
-                four_detections_dist = distance.pdist(four_detections_coo)
-                if np.min(four_detections_dist) > self.min_quad_sep:
-                    subtile_quadlist.append(quad(four_detections_coo, four_detections_dist))
-            full_quadlist.append(subtile_quadlist)
+            # Compute the six pair distances of every candidate quad in one
+            # fused broadcast expression, rather than calling `distance.pdist`
+            # per combination
+            quad_idxs = np.fromiter(
+                itertools.chain.from_iterable(itertools.combinations(range(n_quad_det), 4)),
+                dtype=np.intp,
+            ).reshape(-1, 4)
+            combos = _coo[quad_idxs]
+            pair_dists = np.linalg.norm(
+                combos[:, _QUAD_PAIR_I] - combos[:, _QUAD_PAIR_J], axis=-1
+            )
+            good_quads = pair_dists.min(axis=1) > self.min_quad_sep
+            full_quadlist.append(quads_hash(combos[good_quads], pair_dists[good_quads]))
 
         return full_quadlist
 
@@ -1129,7 +1287,7 @@ class Spalipy:
         # the transformed source coordinates. The upper bound means that
         # any beyond this distance are filled with inf values.
         dists, idxs = self.template_coo_tree.query(
-            source_coo_trans, k=2, distance_upper_bound=2 * self.max_match_dist
+            source_coo_trans, k=2, distance_upper_bound=2 * self.max_match_dist, workers=-1
         )
         # For a match, we require the match distance to be within our limit, and
         # that the second-nearest object is at least double that distance. This is
@@ -1170,29 +1328,69 @@ def calc_affine_transform(source_coo, template_coo):
     n = len(source_coo)
     template_matrix = template_coo.ravel()
     source_matrix = np.zeros((n * 2, 4))
-    source_matrix[::2, :2] = np.column_stack((source_coo[:, 0], -source_coo[:, 1]))
-    source_matrix[1::2, :2] = np.column_stack((source_coo[:, 1], source_coo[:, 0]))
-    source_matrix[:, 2] = np.tile([1, 0], n)
-    source_matrix[:, 3] = np.tile([0, 1], n)
+    source_matrix[::2, 0] = source_coo[:, 0]
+    source_matrix[::2, 1] = -source_coo[:, 1]
+    source_matrix[1::2, 0] = source_coo[:, 1]
+    source_matrix[1::2, 1] = source_coo[:, 0]
+    source_matrix[::2, 2] = 1
+    source_matrix[1::2, 3] = 1
 
     if n == 2:
-        transform = linalg.solve(source_matrix, template_matrix)
+        transform = linalg.solve(source_matrix, template_matrix, check_finite=False)
     else:
-        transform = linalg.lstsq(source_matrix, template_matrix)[0]
+        transform = linalg.lstsq(
+            source_matrix, template_matrix, lapack_driver="gelsd", check_finite=False
+        )[0]
 
     return AffineTransform(transform)
 
 
-def quad(coo, dist):
+# The six index pairs within a quad, in `pdist` condensed order
+_QUAD_PAIR_I = np.array([0, 0, 0, 1, 1, 2])
+_QUAD_PAIR_J = np.array([1, 2, 3, 2, 3, 3])
+
+# Reorderings that place the most-distant pair of detections first, indexed by
+# the position of the maximum distance in `pdist` condensed order
+_QUAD_MAX_DIST_ORDERS = np.array(
+    [
+        [0, 1, 2, 3],
+        [0, 2, 1, 3],
+        [0, 3, 1, 2],
+        [1, 2, 0, 3],
+        [1, 3, 0, 2],
+        [2, 3, 0, 1],
+    ]
+)
+
+# Reorderings applied when breaking symmetries, indexed by (testa + 2 * testb)
+_QUAD_SYMMETRY_ORDERS = np.array(
+    [
+        [0, 1, 2, 3],
+        [0, 1, 3, 2],
+        [1, 0, 3, 2],
+        [1, 0, 2, 3],
+    ]
+)
+
+
+def quads_hash(combos, dists):
     """
-    Create a hash from a combination of four detections coordinates and distances (a "quad").
+    Create hashes for a batch of four-detection combinations ("quads").
+
+    Parameters
+    ----------
+    combos : numpy.ndarray
+        The detection coordinates of the quads, of shape (nquads, 4, 2).
+    dists : numpy.ndarray
+        The six pairwise distances within each quad, in `pdist` condensed
+        order, of shape (nquads, 6).
 
     Returns
     -------
-    coo : numpy.ndarray
-        The four detection coordinates in the correct (expected) quad order.
-    hash : tuple
-        A hash sequence describing the quad.
+    combos : numpy.ndarray
+        The detection coordinates in the correct (expected) quad order.
+    hashes : numpy.ndarray
+        The hash sequences describing the quads, of shape (nquads, 4).
 
     References
     ----------
@@ -1202,48 +1400,36 @@ def quad(coo, dist):
     calibration of arbitrary astronomical images", AJ, 2010.
     """
 
-    max_dist_idx = int(np.argmax(dist))
-    orders = [
-        (0, 1, 2, 3),
-        (0, 2, 1, 3),
-        (0, 3, 1, 2),
-        (1, 2, 0, 3),
-        (1, 3, 0, 2),
-        (2, 3, 0, 1),
-    ]
-    order = orders[max_dist_idx]
-    coo = coo[order, :]
-    # Look for matrix transform [[a -b], [b a]] + [c d]
-    # that brings A and B to 00 11 :
-    x = coo[1, 0] - coo[0, 0]
-    y = coo[1, 1] - coo[0, 1]
+    nquads = len(combos)
+    quad_arange = np.arange(nquads)[:, None]
+    max_dist_idx = np.argmax(dists, axis=1)
+    combos = combos[quad_arange, _QUAD_MAX_DIST_ORDERS[max_dist_idx]]
+    # Look for matrix transforms [[a -b], [b a]] + [c d]
+    # that bring A and B to 00 11 :
+    x = combos[:, 1, 0] - combos[:, 0, 0]
+    y = combos[:, 1, 1] - combos[:, 0, 1]
     b = (x - y) / (x**2 + y**2)
     a = (1 / x) * (1 + b * y)
-    c = b * coo[0, 1] - a * coo[0, 0]
-    d = -(b * coo[0, 0] + a * coo[0, 1])
+    c = b * combos[:, 0, 1] - a * combos[:, 0, 0]
+    d = -(b * combos[:, 0, 0] + a * combos[:, 0, 1])
 
-    t = AffineTransform((a, b, c, d))
-    (xC, yC) = t.apply_transform((coo[2, 0], coo[2, 1])).ravel()
-    (xD, yD) = t.apply_transform((coo[3, 0], coo[3, 1])).ravel()
+    # Apply the transforms to points C and D of every quad directly
+    xC = a * combos[:, 2, 0] - b * combos[:, 2, 1] + c
+    yC = b * combos[:, 2, 0] + a * combos[:, 2, 1] + d
+    xD = a * combos[:, 3, 0] - b * combos[:, 3, 1] + c
+    yD = b * combos[:, 3, 0] + a * combos[:, 3, 1] + d
 
-    _hash = (xC, yC, xD, yD)
+    hashes = np.stack((xC, yC, xD, yD), axis=1)
     # Break symmetries if needed
-    testa = xC > xD
-    testb = xC + xD > 1
-    if testa:
-        if testb:
-            _hash = (1.0 - xC, 1.0 - yC, 1.0 - xD, 1.0 - yD)
-            order = (1, 0, 2, 3)
-        else:
-            _hash = (xD, yD, xC, yC)
-            order = (0, 1, 3, 2)
-    elif testb:
-        _hash = (1.0 - xD, 1.0 - yD, 1.0 - xC, 1.0 - yC)
-        order = (1, 0, 3, 2)
-    else:
-        order = (0, 1, 2, 3)
-
-    return coo[order, :], _hash
+    testa = (xC > xD)[:, None]
+    testb = ((xC + xD) > 1)[:, None]
+    swapped = hashes[:, [2, 3, 0, 1]]
+    hashes = np.where(testa, np.where(testb, 1.0 - hashes, swapped), hashes)
+    hashes = np.where(~testa & testb, 1.0 - swapped, hashes)
+    symmetry_idx = testa[:, 0] + 2 * testb[:, 0]
+    combos = combos[quad_arange, _QUAD_SYMMETRY_ORDERS[symmetry_idx]]
+
+    return combos, hashes
 
 
 def _read_sextractor_cat(cat_filename):
@@ -33,6 +33,30 @@ def _memmap_tryfree(obj: Any) -> bool:
     return False
 
 
+def _memmap_create_empty(
+    shape: tuple, dtype, temp_dir: Union[Path, str, None] = None
+) -> np.memmap:
+    """
+    Create and return an uninitialised temporary file np.memmap object of the
+    given shape and dtype, suitable for writing interpolation output into
+    directly. The temporary file handling follows `_memmap_create_temp()`.
+    """
+    tmp_file = tempfile.TemporaryFile(
+        mode="w+b",
+        prefix=rf"spalipy_{int(time())}_",
+        suffix=r".dat",
+        dir=temp_dir,
+    )
+    tmp_file.truncate(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.memmap(
+        tmp_file,
+        mode="r+",
+        dtype=dtype,
+        shape=shape,
+        order="C",
+    )
+
+
 def _memmap_create_temp(
     ndarray_to_save: np.ndarray, temp_dir: Union[Path, str, None] = None
 ) -> np.memmap:
@@ -206,8 +206,8 @@ class TestSpalipy(unittest.TestCase):
             quad_edge_buffer=100,
         )
         sp.align()
-        assert len(sp.source_quadlist[0]) == 486
-        assert len(sp.template_quadlist[0]) == 2
+        assert len(sp.source_quadlist[0][0]) == 486
+        assert len(sp.template_quadlist) == 2
         assert np.allclose(sp.affine_transform.v, self.expected_affine_transform_simple)
 
     def test_preserve_footprints(self):